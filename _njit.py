@@ -0,0 +1,10 @@
+try:
+    from numba import njit, prange
+except ImportError:
+    # Fall back to plain Python execution when numba is not installed
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda func: func
+    
+    prange = range
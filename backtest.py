@@ -1,10 +1,169 @@
+import numpy as np
 import pandas as pd
-import math, statistics
+import math
+from _njit import njit, prange
 
-class BacktestingModel(object):
+@njit(cache=True)
+def _compute_spread_and_zscore(indep_price, dep_price, hedge_ratio, residual, lookback, spread, zscore):
+    '''
+    Function to compute spread and residual z-score of a pair in a single streaming pass 
+    
+    Parameters:
+    -----------
+    indep_price: numpy array of independent ticker prices 
+    dep_price: numpy array of dependent ticker prices 
+    hedge_ratio: ratio between the tickers 
+    residual: numpy array of cointegration residuals 
+    lookback: size of the rolling window 
+    spread: output array of spread 
+    zscore: output array of residual z-score 
+    '''
+    
+    n = residual.shape[0]
+    zscore[:] = np.nan
+    s, s2, flat = 0.0, 0.0, 0
+    for i in range(n):
+        spread[i] = dep_price[i] - indep_price[i] * hedge_ratio
+        # Count trailing repeats to detect flat windows 
+        flat = flat + 1 if i > 0 and residual[i] == residual[i-1] else 0
+        # Add the incoming residual and drop the outgoing one, accumulating in float64 
+        x = np.float64(residual[i])
+        s += x
+        s2 += x * x
+        if lookback >= 1 and i >= lookback:
+            x_out = np.float64(residual[i-lookback])
+            s -= x_out
+            s2 -= x_out * x_out
+        if lookback >= 2 and i >= lookback - 1:
+            var = (s2 - s * s/ lookback)/ (lookback - 1)
+            # Flat windows have zero variance but running sums leave drift - keep them NaN as pandas does 
+            if var > 0.0 and flat < lookback - 1:
+                zscore[i] = (x - s/ lookback)/ math.sqrt(var)
+
+@njit(cache=True, parallel=True)
+def _compute_spreads_and_zscores(prices, indep_rows, dep_rows, hedge_ratios, residuals, lookbacks):
+    '''
+    Function to compute spreads and residual z-scores of all pairs in parallel 
+    
+    Parameters:
+    -----------
+    prices: 2D array of ticker prices (tickers x ticks) 
+    indep_rows: array of independent ticker rows in prices 
+    dep_rows: array of dependent ticker rows in prices 
+    hedge_ratios: array of hedge ratios 
+    residuals: 2D float32 array of cointegration residuals (pairs x ticks) 
+    lookbacks: array of rolling window sizes 
+    
+    Returns
+    -------
+    2D arrays of spreads and residual z-scores (pairs x ticks) 
+    '''
+    
+    num_pairs, n = residuals.shape
+    spreads = np.empty((num_pairs, n))
+    zscores = np.empty((num_pairs, n))
+    for p in prange(num_pairs):
+        _compute_spread_and_zscore(prices[indep_rows[p]], prices[dep_rows[p]], hedge_ratios[p], residuals[p], lookbacks[p], spreads[p], zscores[p])
+    return spreads, zscores
+
+@njit(cache=True)
+def _simulate_pair(spread, long_sig, entry, exit_long, exit_short, init_cap, trade_start_idx, trade_end_idx, pnl_val, cap_val):
+    '''
+    Function to simulate trading of a single cointegrated pair into preallocated buffers 
+    
+    Parameters:
+    -----------
+    spread: numpy array of spreads between the independent and dependent tickers 
+    long_sig: boolean array of long entry signals 
+    entry: boolean array of long or short entry signals 
+    exit_long: boolean array of exit signals for a long position 
+    exit_short: boolean array of exit signals for a short position 
+    init_cap: floating value of initial capital 
+    trade_start_idx: output array of trade start indices 
+    trade_end_idx: output array of trade end indices 
+    pnl_val: output array of pnl values 
+    cap_val: output array of capital values 
+    
+    Returns
+    -------
+    number of trades, number of ticks traded 
+    '''
+    
+    n = spread.shape[0]
+    cap_val[0] = init_cap
+    start_cap = init_cap
+    if start_cap <= 0:
+        return 0, 0
+    
+    # Walk the signal indices trade by trade rather than tick by tick 
+    entry_idx = np.flatnonzero(entry)
+    exit_long_idx = np.flatnonzero(exit_long)
+    exit_short_idx = np.flatnonzero(exit_short)
+    e, xl, xs = 0, 0, 0
+    n_trades, i = 0, 0
+    
+    while True:
+        # Open a position at the next entry signal - buy (1) or sell (-1) the spread 
+        while e < entry_idx.shape[0] and entry_idx[e] < i:
+            e += 1
+        # A position opened on the last trading day is never closed 
+        if e == entry_idx.shape[0] or entry_idx[e] == n - 1:
+            break
+        start_idx = entry_idx[e]
+        start_pos = 2 * int(long_sig[start_idx]) - 1
+        start_spread = spread[start_idx]
+        start_num_spread = start_cap/ abs(start_spread)
+        
+        # Take profit at the next exit signal for the position, else close on the last trading day 
+        if start_pos == 1:
+            while xl < exit_long_idx.shape[0] and exit_long_idx[xl] <= start_idx:
+                xl += 1
+            end_idx = exit_long_idx[xl] if xl < exit_long_idx.shape[0] else n - 1
+        else:
+            while xs < exit_short_idx.shape[0] and exit_short_idx[xs] <= start_idx:
+                xs += 1
+            end_idx = exit_short_idx[xs] if xs < exit_short_idx.shape[0] else n - 1
+        
+        pnl = (spread[end_idx] - start_spread) * start_num_spread * start_pos
+        start_cap = start_cap + pnl
+        trade_start_idx[n_trades] = start_idx
+        trade_end_idx[n_trades] = end_idx
+        pnl_val[n_trades] = pnl
+        cap_val[n_trades + 1] = start_cap
+        n_trades += 1
+        i = end_idx + 1
+        
+        # Stop trading if capital becomes negative
+        if start_cap <= 0:
+            return n_trades, i
+    
+    return n_trades, n
+
+@njit(cache=True, parallel=True)
+def _simulate_all(spreads, long_sig, entry, exit_long, exit_short, init_cap, out_trade_start, out_trade_end, out_pnl, out_cap, out_trade_n, out_tick_n):
+    '''
+    Function to simulate trading of all cointegrated pairs in parallel 
+    
+    Parameters:
+    -----------
+    spreads: 2D array of spreads (pairs x ticks) 
+    long_sig, entry, exit_long, exit_short: 2D boolean arrays of trading signals (pairs x ticks) 
+    init_cap: floating value of initial capital 
+    out_trade_start, out_trade_end, out_pnl, out_cap: 2D output arrays of per-pair trade results 
+    out_trade_n, out_tick_n: output arrays of number of trades and ticks traded per pair 
+    '''
+    
+    for p in prange(spreads.shape[0]):
+        out_trade_n[p], out_tick_n[p] = _simulate_pair(spreads[p], long_sig[p], entry[p], exit_long[p], exit_short[p], init_cap,
+                                                       out_trade_start[p], out_trade_end[p], out_pnl[p], out_cap[p])
+
+class BacktestingModel:
     '''
     BacktestingModel class for computation of backtesting metrics 
     '''
+    
+    __slots__ = ('coint_pairs', 'data', 'init_cap', 'std', 'residuals', '_spreads', '_zscores', 'zscores', 'trade_dates', 'pnl_vals', 'cap_vals',
+                 'all_spreads', 'pnl_pcts', 'win_pcts', 'tot_trades', 'max_wins', 'max_losses', 'sharpe_ratios')
         
     def initialise_model(self, coint_pairs, data, init_cap, std):
         '''
@@ -22,6 +181,12 @@ class BacktestingModel(object):
         self.data = data
         self.init_cap = init_cap 
         self.std = std
+        # Pack residuals of all pairs into a single float32 array (pairs x ticks) 
+        if coint_pairs:
+            self.residuals = np.vstack([coint_res[2].to_numpy(dtype=np.float32) for coint_res in coint_pairs.values()])
+        else:
+            self.residuals = np.empty((0, len(data.get('price'))), dtype=np.float32)
+        self._spreads, self._zscores = self.get_spreads_zscores()
         self.zscores = self.get_zscores()  
         
     def get_zscores(self):
@@ -33,15 +198,34 @@ class BacktestingModel(object):
         dictionary of z-score series 
         '''
         
-        zscores = {}
-        for key_pair, coint_res in self.coint_pairs.items():
-            lookback = math.ceil(coint_res[1])
-            spread_window = coint_res[2].rolling(window=lookback)
-            spread_avg = spread_window.mean()
-            spread_std = spread_window.std()
-            zscore = (coint_res[2] - spread_avg)/ spread_std 
-            zscores[key_pair] = zscore
-        return zscores 
+        return {key_pair: pd.Series(self._zscores[p], index=coint_res[2].index) for p, (key_pair, coint_res) in enumerate(self.coint_pairs.items())}
+    
+    def get_spreads_zscores(self):
+        '''
+        Function to compute spreads and residual z-scores of all co-integrated pairs in a single pass 
+        
+        Returns
+        -------
+        2D arrays of spreads and residual z-scores (pairs x ticks), with rows in the order of coint_pairs 
+        '''
+        
+        price = self.data.get('price')
+        # Convert each ticker's prices once, as tickers are shared across pairs 
+        ticker_rows = {}
+        for key_pair in self.coint_pairs:
+            for ticker_id in key_pair:
+                ticker_rows.setdefault(ticker_id, len(ticker_rows))
+        prices = np.empty((len(ticker_rows), len(price)))
+        for ticker_id, row in ticker_rows.items():
+            prices[row] = price[ticker_id].to_numpy(dtype=np.float64, copy=False)
+        
+        indep_rows = np.array([ticker_rows[key_pair[0]] for key_pair in self.coint_pairs], dtype=np.int64)
+        dep_rows = np.array([ticker_rows[key_pair[1]] for key_pair in self.coint_pairs], dtype=np.int64)
+        hedge_ratios = np.array([coint_res[0] for coint_res in self.coint_pairs.values()], dtype=np.float64)
+        lookbacks = np.array([math.ceil(coint_res[1]) for coint_res in self.coint_pairs.values()], dtype=np.int64)
+        if (lookbacks < 0).any():
+            raise ValueError('window must be an integer 0 or greater')
+        return _compute_spreads_and_zscores(prices, indep_rows, dep_rows, hedge_ratios, self.residuals, lookbacks)
     
     def get_spread(self, indep_price, dep_price, hedge_ratio):
         '''
@@ -77,10 +261,7 @@ class BacktestingModel(object):
         pnl 
         '''
         
-        if start_pos == 1:
-            return (end_spread - start_spread) * start_num_spread
-        else:
-            return (start_spread - end_spread) * start_num_spread
+        return (end_spread - start_spread) * start_num_spread * start_pos
     
     def run(self):
         '''
@@ -88,62 +269,39 @@ class BacktestingModel(object):
         
         Returns
         -------
-        dictionary of key backtesting metrics/ results 
+        dictionary of key backtesting metrics/ results - trade dates as lists of (start, end) date tuples, 
+        pnl values, capital values and spreads as numpy arrays 
         '''
 
         trade_dates, pnl_vals, cap_vals, all_spreads = {}, {}, {}, {}
         dates = self.data.get('dates') 
+        std, init_cap = self.std, self.init_cap
+        spreads, zscores = self._spreads, self._zscores
+        key_pairs = list(self.coint_pairs.keys())
+        num_pairs, num_ticks = spreads.shape
         
-        for key_pair, coint_res in self.coint_pairs.items():
-            indep_ticker_id, dep_ticker_id = key_pair[0], key_pair[1]
-            indep_price = self.data.get('price')[indep_ticker_id].tolist()
-            dep_price = self.data.get('price')[dep_ticker_id].tolist()
-            hedge_ratio = coint_res[0]
-            zscore = self.zscores.get(key_pair).tolist()
-            trade_date, pnl_val, cap_val, all_spread = [], [], [self.init_cap, ], []
-            start_spread, start_price, start_pos, start_num_spread, start_cap, start_date = None, None, 0, None, self.init_cap, None 
-            
-            for i in range(len(zscore)):
-                # Stop trading if capital becomes negative
-                if start_cap <= 0:
-                    break
-                # Last Trading Day - close the position 
-                if i == (len(zscore)-1) and start_pos != 0:
-                    end_spread = self.get_spread(indep_price[i], dep_price[i], hedge_ratio)
-                    pnl = self.get_pnl(start_pos, start_spread, end_spread, start_num_spread)
-                    start_cap = start_cap + pnl
-                    trade_date.append((start_date, dates[i]))
-                    pnl_val.append(pnl)
-                    cap_val.append(start_cap) 
-                    start_pos = 0
-                # Open a position - buy or long the spread 
-                elif start_pos == 0 and zscore[i] < -self.std:
-                    start_spread = self.get_spread(indep_price[i], dep_price[i], hedge_ratio)
-                    start_pos = 1 
-                    start_num_spread = start_cap/abs(start_spread)
-                    start_date = dates[i]
-                # Open a position - sell the spread 
-                elif start_pos == 0 and zscore[i] > self.std:
-                    start_spread = self.get_spread(indep_price[i], dep_price[i], hedge_ratio)
-                    start_pos = -1 
-                    start_num_spread = start_cap/abs(start_spread)
-                    start_date = dates[i]
-                # Take profit immediately once mean reverted 
-                elif (start_pos != 0 and abs(zscore[i]) < 0.5) or (start_pos == 1 and zscore[i] > 0) or (start_pos == -1 and zscore[i] < 0):
-                    end_spread = self.get_spread(indep_price[i], dep_price[i], hedge_ratio)
-                    pnl = self.get_pnl(start_pos, start_spread, end_spread, start_num_spread)
-                    start_cap = start_cap + pnl
-                    trade_date.append((start_date, dates[i]))
-                    pnl_val.append(pnl)
-                    cap_val.append(start_cap)
-                    start_pos = 0
-                    
-                all_spread.append(self.get_spread(indep_price[i], dep_price[i], hedge_ratio))
-                    
-            trade_dates[key_pair] = trade_date
-            pnl_vals[key_pair] = pnl_val
-            cap_vals[key_pair] = cap_val
-            all_spreads[key_pair] = all_spread
+        # Precompute entry and exit signals 
+        long_sig = zscores < -std
+        entry = long_sig | (zscores > std)
+        mean_rev = np.abs(zscores) < 0.5
+        exit_long = mean_rev | (zscores > 0)
+        exit_short = mean_rev | (zscores < 0)
+        
+        out_trade_start = np.empty((num_pairs, num_ticks), dtype=np.int64)
+        out_trade_end = np.empty((num_pairs, num_ticks), dtype=np.int64)
+        out_pnl = np.empty((num_pairs, num_ticks))
+        out_cap = np.empty((num_pairs, num_ticks + 1))
+        out_trade_n = np.empty(num_pairs, dtype=np.int64)
+        out_tick_n = np.empty(num_pairs, dtype=np.int64)
+        _simulate_all(spreads, long_sig, entry, exit_long, exit_short, init_cap,
+                      out_trade_start, out_trade_end, out_pnl, out_cap, out_trade_n, out_tick_n)
+        
+        for p, (key_pair, n_trades, n_ticks) in enumerate(zip(key_pairs, out_trade_n.tolist(), out_tick_n.tolist())):
+            # Map trade indices back to dates 
+            trade_dates[key_pair] = [(dates[start_idx], dates[end_idx]) for start_idx, end_idx in zip(out_trade_start[p, :n_trades].tolist(), out_trade_end[p, :n_trades].tolist())]
+            pnl_vals[key_pair] = out_pnl[p, :n_trades].copy()
+            cap_vals[key_pair] = out_cap[p, :n_trades + 1].copy()
+            all_spreads[key_pair] = spreads[p, :n_ticks].copy()
             
         self.trade_dates = trade_dates 
         self.pnl_vals = pnl_vals
@@ -157,6 +315,53 @@ class BacktestingModel(object):
             'all_spreads': self.all_spreads
         }
     
+    def get_pair_metrics(self, key_pair, coint_res, num_days):
+        '''
+        Function to compute curated backtesting metrics for a cointegrated pair 
+        
+        Parameters:
+        -----------
+        key_pair: tuple of independent and dependent ticker names 
+        coint_res: list of cointegrated pair's key info 
+        num_days: number of trading days 
+        
+        Returns
+        -------
+        tuple of pnl %, win %, total trades, max win, max loss, sharpe ratio, or None if the pair fails screening 
+        '''
+        
+        init_cap = self.init_cap
+        cap_arr = np.asarray(self.cap_vals.get(key_pair), dtype=np.float64)
+        pnl_pct = (cap_arr[-1] - init_cap)/ init_cap
+        # Discard on the cheap gates before computing trade stats 
+        if pnl_pct < 0.3 or coint_res[0] <= 0:
+            return None
+        
+        pnl_arr = np.asarray(self.pnl_vals.get(key_pair), dtype=np.float64)
+        win_mask = pnl_arr > 0
+        win_trade = int(win_mask.sum())
+        lose_trade = pnl_arr.size - win_trade
+        tot_trade = win_trade + lose_trade
+        if tot_trade == 0:
+            return None
+        win_pct = win_trade/ tot_trade
+              
+        if tot_trade <= num_days//100 or win_pct < 0.3:
+            return None
+        
+        pnl_pct_lst = np.diff(cap_arr)/ cap_arr[:-1]
+        # Sharpe ratio is undefined without at least two distinct returns 
+        pnl_pct_std = pnl_pct_lst.std(ddof=1) if pnl_pct_lst.size > 1 else 0.0
+        if not pnl_pct_std > 0:
+            return None
+        sharpe_ratio = pnl_pct_lst.mean()/ pnl_pct_std
+        if sharpe_ratio <= 0.5:
+            return None
+        
+        max_win = pnl_arr[win_mask].max(initial=0.0)
+        max_loss = pnl_arr[~win_mask].min(initial=0.0)
+        return pnl_pct, win_pct, tot_trade, max_win, max_loss, sharpe_ratio
+    
     def compute_bt_metrics(self):
         '''
         Function to screen for quality cointegrated pairs 
@@ -169,30 +374,12 @@ class BacktestingModel(object):
         pnl_pcts, win_pcts, tot_trades, max_wins, max_losses, sharpe_ratios = {}, {}, {}, {}, {}, {}
         num_days = len(self.data.get('dates'))
         
+        get_pair_metrics = self.get_pair_metrics
         for key_pair, coint_res in self.coint_pairs.items():
-            pnl = self.pnl_vals.get(key_pair)
-            tot_pnl = sum(pnl)
-            pnl_pct = (self.cap_vals.get(key_pair)[-1] - self.init_cap)/ self.init_cap
-            win_trade = sum(1 for i in pnl if i > 0)
-            lose_trade = sum(1 for i in pnl if i <= 0)
-            tot_trade = win_trade + lose_trade
-            win_pct = win_trade/ tot_trade
-                  
-            if pnl_pct < 0.3 or tot_trade <= num_days//100 or win_pct < 0.3 or coint_res[0] <= 0:
+            metrics = get_pair_metrics(key_pair, coint_res, num_days)
+            if metrics is None:
                 continue
-            else:
-                pnl_pct_lst = pd.Series(self.cap_vals.get(key_pair)).pct_change()[1:]
-                sharpe_ratio = statistics.mean(pnl_pct_lst)/ statistics.stdev(pnl_pct_lst)
-                if sharpe_ratio > 0.5:
-                    max_win = max(list(i for i in pnl if i > 0), default=0)
-                    max_loss = min(list(i for i in pnl if i <= 0), default=0)
-                    
-                    pnl_pcts[key_pair] = pnl_pct
-                    win_pcts[key_pair] = win_pct
-                    tot_trades[key_pair] = tot_trade
-                    max_wins[key_pair] = max_win
-                    max_losses[key_pair] = max_loss
-                    sharpe_ratios[key_pair] = sharpe_ratio
+            pnl_pcts[key_pair], win_pcts[key_pair], tot_trades[key_pair], max_wins[key_pair], max_losses[key_pair], sharpe_ratios[key_pair] = metrics
                              
         self.pnl_pcts = pnl_pcts
         self.win_pcts = win_pcts